@@ -1,13 +1,20 @@
 # -*- coding: utf-8 -*-
 # Copyright (c) Alibaba, Inc. and its affiliates.
-import copy
+import functools
+import hashlib
+import inspect
+import itertools
+import logging
 import os.path
 import random
-from collections import OrderedDict
+import re
 
+import numpy as np
 import torch
 import torch.nn.functional as F
 from PIL.Image import Image
+from scepter.modules.model.backbone.unet.unet_utils import (
+    FP8Linear, convert_feedforward_to_fp8, fp8_is_available)
 from scepter.modules.model.network.diffusion.diffusion import GaussianDiffusion
 from scepter.modules.model.network.diffusion.schedules import noise_schedule
 from scepter.modules.model.registry import (BACKBONES, EMBEDDERS, MODELS,
@@ -19,12 +26,78 @@ from scepter.studio.utils.env import get_available_memory
 from .control_inference import ControlInference
 from .tuner_inference import TunerInference
 
+# mmap loading and load_state_dict(assign=True) need torch >= 2.1
+_TORCH_LOAD_MMAP = 'mmap' in inspect.signature(torch.load).parameters
+_LOAD_STATE_ASSIGN = 'assign' in inspect.signature(
+    torch.nn.Module.load_state_dict).parameters
+
+_SPLIT_MODULES = ('first_stage_model', 'cond_stage_model', 'diffusion_model')
+
+# key prefixes of a monolithic checkpoint, the matched group gives the module
+_PREFIX_RE = re.compile(r'^(?:(first_stage_model\.)|(conditioner\.)|'
+                        r'(cond_stage_model\.(?:model\.)?)|'
+                        r'(model\.diffusion_model\.))')
+_PREFIX_MODULES = {
+    1: 'first_stage_model',
+    2: 'cond_stage_model',
+    3: 'cond_stage_model',
+    4: 'diffusion_model'
+}
+
 
 def get_model(model_tuple):
     assert 'model' in model_tuple
     return model_tuple['model']
 
 
+def samples_to_images(x_samples):
+    # map the decoded samples from [-1, 1] to [0, 1] with in-place ops
+    return x_samples.float().add_(1.0).mul_(0.5).clamp_(0.0, 1.0)
+
+
+def model_to(model, device, non_blocking=False):
+    # move the wrapped module of a compiled model in place, the compiled
+    # wrapper keeps referring to it.
+    if hasattr(model, '_orig_mod'):
+        model._orig_mod.to(device, non_blocking=non_blocking)
+        return model
+    return model.to(device, non_blocking=non_blocking)
+
+
+def load_torch_checkpoint(path):
+    # mmap the checkpoint when supported, so tensors are paged in lazily
+    if _TORCH_LOAD_MMAP:
+        try:
+            return torch.load(path, map_location='cpu', mmap=True)
+        except RuntimeError:
+            # legacy (non zipfile) checkpoints can not be mmapped
+            pass
+    return torch.load(path, map_location='cpu')
+
+
+def split_state_key(key):
+    """
+    Map a key of a monolithic checkpoint to the module it belongs to.
+    :param key: the key of the whole state dict, e.g. model.diffusion_model.out.0.weight
+    :return: (module name, key inside the module) or (None, None)
+    """
+    m = _PREFIX_RE.match(key)
+    if m is None:
+        return None, None
+    return _PREFIX_MODULES[m.lastindex], key[m.end():]
+
+
+def untie_state_dict(sd):
+    # safetensors refuses tensors sharing storage, clone the repeated ones.
+    storages = set()
+    for k, v in sd.items():
+        ptr = v.untyped_storage().data_ptr()
+        if ptr in storages or not v.is_contiguous():
+            sd[k] = v.clone(memory_format=torch.contiguous_format)
+        storages.add(ptr)
+    return sd
+
+
 class DiffusionInference():
     '''
         define vae, unet, text-encoder, tuner, refiner components
@@ -39,11 +112,19 @@ class DiffusionInference():
         ]
         self.tuner_infer = TunerInference(self.logger)
         self.control_infer = ControlInference(self.logger)
+        # compiled models stay resident on the device across unloads, they
+        # are only evicted (and released) when unload runs short of memory.
+        self._compile_cache = {}
+        self._norm_cache = {}
+        self._copy_stream = None
+        self._tokenize_cached = functools.lru_cache(maxsize=1024)(
+            self._tokenize)
 
     def init_from_cfg(self, cfg):
         self.name = cfg.NAME
         self.is_default = cfg.get('IS_DEFAULT', False)
         module_paras = self.load_default(cfg.get('DEFAULT_PARAS', None))
+        self.init_backend(getattr(self, 'paras', None))
         assert cfg.have('MODEL')
         cfg.MODEL = self.redefine_paras(cfg.MODEL)
         self.diffusion = self.load_schedule(cfg.MODEL.SCHEDULE)
@@ -70,92 +151,108 @@ class DiffusionInference():
             cfg.MODEL.REFINER_MODEL, module_paras.get(
                 'REFINER_MODEL',
                 None)) if cfg.MODEL.have('REFINER_MODEL') else None
+        if self.first_stage_model is not None:
+            paras = self.first_stage_model['paras']
+            if 'scale_factor' in paras:
+                paras['inv_scale_factor'] = 1. / paras['scale_factor']
         self.tokenizer = TOKENIZERS.build(
             cfg.MODEL.TOKENIZER,
             logger=self.logger) if cfg.MODEL.have('TOKENIZER') else None
+        self._tokenize_cached.cache_clear()
 
         if self.tokenizer is not None:
             self.cond_stage_model['cfg'].KWARGS = {
                 'vocab_size': self.tokenizer.vocab_size
             }
 
+    def init_backend(self, paras):
+        # tf32 and cudnn autotuning change the numerics of the whole process,
+        # they are only switched on when the inference config asks for them.
+        if paras is None:
+            return
+        if paras.get('ALLOW_TF32', False):
+            torch.backends.cuda.matmul.allow_tf32 = True
+            torch.backends.cudnn.allow_tf32 = True
+        if paras.get('CUDNN_BENCHMARK', False):
+            torch.backends.cudnn.benchmark = True
+
     def redefine_paras(self, cfg):
         if cfg.get('PRETRAINED_MODEL', None):
             assert FS.isfile(cfg.PRETRAINED_MODEL)
             with FS.get_from(cfg.PRETRAINED_MODEL,
                              wait_finish=True) as local_path:
-                if local_path.endswith('safetensors'):
-                    from safetensors.torch import load_file as load_safetensors
-                    sd = load_safetensors(local_path)
-                else:
-                    sd = torch.load(local_path, map_location='cpu')
-                first_stage_model_path = os.path.join(
-                    os.path.dirname(local_path), 'first_stage_model.pth')
-                cond_stage_model_path = os.path.join(
-                    os.path.dirname(local_path), 'cond_stage_model.pth')
-                diffusion_model_path = os.path.join(
-                    os.path.dirname(local_path), 'diffusion_model.pth')
-                if (not os.path.exists(first_stage_model_path)
-                        or not os.path.exists(cond_stage_model_path)
-                        or not os.path.exists(diffusion_model_path)):
+                model_dir = os.path.dirname(local_path)
+                module_paths = {
+                    name: os.path.join(model_dir, f'{name}.safetensors')
+                    for name in _SPLIT_MODULES
+                }
+                split_modules = [
+                    name for name in _SPLIT_MODULES
+                    if cfg.have(name.upper())
+                    and not os.path.exists(module_paths[name])
+                ]
+                if len(split_modules) > 0:
                     self.logger.info(
                         'Now read the whole model and rearrange the modules, it may take several mins.'
                     )
-                    first_stage_model = OrderedDict()
-                    cond_stage_model = OrderedDict()
-                    diffusion_model = OrderedDict()
-                    for k, v in sd.items():
-                        if k.startswith('first_stage_model.'):
-                            first_stage_model[k.replace(
-                                'first_stage_model.', '')] = v
-                        elif k.startswith('conditioner.'):
-                            cond_stage_model[k.replace('conditioner.', '')] = v
-                        elif k.startswith('cond_stage_model.'):
-                            if k.startswith('cond_stage_model.model.'):
-                                cond_stage_model[k.replace(
-                                    'cond_stage_model.model.', '')] = v
-                            else:
-                                cond_stage_model[k.replace(
-                                    'cond_stage_model.', '')] = v
-                        elif k.startswith('model.diffusion_model.'):
-                            diffusion_model[k.replace('model.diffusion_model.',
-                                                      '')] = v
-                        else:
-                            continue
-                    if cfg.have('FIRST_STAGE_MODEL'):
-                        with open(first_stage_model_path + 'cache', 'wb') as f:
-                            torch.save(first_stage_model, f)
-                        os.rename(first_stage_model_path + 'cache',
-                                  first_stage_model_path)
-                        self.logger.info(
-                            'First stage model has been processed.')
-                    if cfg.have('COND_STAGE_MODEL'):
-                        with open(cond_stage_model_path + 'cache', 'wb') as f:
-                            torch.save(cond_stage_model, f)
-                        os.rename(cond_stage_model_path + 'cache',
-                                  cond_stage_model_path)
-                        self.logger.info(
-                            'Cond stage model has been processed.')
-                    if cfg.have('DIFFUSION_MODEL'):
-                        with open(diffusion_model_path + 'cache', 'wb') as f:
-                            torch.save(diffusion_model, f)
-                        os.rename(diffusion_model_path + 'cache',
-                                  diffusion_model_path)
-                        self.logger.info('Diffusion model has been processed.')
-                if not cfg.FIRST_STAGE_MODEL.get('PRETRAINED_MODEL', None):
-                    cfg.FIRST_STAGE_MODEL.PRETRAINED_MODEL = first_stage_model_path
-                else:
-                    cfg.FIRST_STAGE_MODEL.RELOAD_MODEL = first_stage_model_path
-                if not cfg.COND_STAGE_MODEL.get('PRETRAINED_MODEL', None):
-                    cfg.COND_STAGE_MODEL.PRETRAINED_MODEL = cond_stage_model_path
-                else:
-                    cfg.COND_STAGE_MODEL.RELOAD_MODEL = cond_stage_model_path
-                if not cfg.DIFFUSION_MODEL.get('PRETRAINED_MODEL', None):
-                    cfg.DIFFUSION_MODEL.PRETRAINED_MODEL = diffusion_model_path
-                else:
-                    cfg.DIFFUSION_MODEL.RELOAD_MODEL = diffusion_model_path
+                    self.split_checkpoint(local_path, module_paths,
+                                          split_modules)
+                for name in _SPLIT_MODULES:
+                    module_cfg = cfg.get(name.upper())
+                    if not module_cfg.get('PRETRAINED_MODEL', None):
+                        module_cfg.PRETRAINED_MODEL = module_paths[name]
+                    else:
+                        module_cfg.RELOAD_MODEL = module_paths[name]
         return cfg
 
+    def split_state_key(self, key):
+        return split_state_key(key)
+
+    def split_checkpoint(self, local_path, module_paths, split_modules):
+        from safetensors import safe_open
+        from safetensors.torch import save_file
+        lazy = local_path.endswith('safetensors')
+        modules = {name: {} for name in split_modules}
+        if lazy:
+            # only classify the keys, the tensors of every module are read
+            # from the mmapped file when the module is saved.
+            with safe_open(local_path, framework='pt', device='cpu') as f:
+                for k in f.keys():
+                    name, new_k = self.split_state_key(k)
+                    if name in modules:
+                        modules[name][new_k] = k
+        else:
+            # the checkpoint is mmapped, a tensor is only paged in when its
+            # module is saved.
+            sd = load_torch_checkpoint(local_path)
+            if isinstance(sd.get('model', None), dict):
+                sd = sd['model']
+            for k, v in sd.items():
+                name, new_k = self.split_state_key(k)
+                if name in modules:
+                    modules[name][new_k] = v
+            del sd
+
+        def save_module(name):
+            path = module_paths[name]
+            module_sd = modules.pop(name)
+            if lazy:
+                with safe_open(local_path, framework='pt',
+                               device='cpu') as f:
+                    module_sd = {
+                        new_k: f.get_tensor(k)
+                        for new_k, k in module_sd.items()
+                    }
+            else:
+                module_sd = untie_state_dict(module_sd)
+            save_file(module_sd, path + 'cache', metadata={'format': 'pt'})
+            os.rename(path + 'cache', path)
+            self.logger.debug('%s has been processed.', name)
+
+        # one module is built and written at a time
+        for name in split_modules:
+            save_module(name)
+
     def init_from_modules(self, modules):
         for k, v in modules.items():
             self.__setattr__(k, v)
@@ -189,27 +286,41 @@ class DiffusionInference():
         module['function_info'] = function_info
         return module
 
-    def init_from_ckpt(self, path, model, ignore_keys=list()):
+    def init_from_ckpt(self, path, model, ignore_keys=list(), device='cpu'):
+        # tensors are read straight to the target device (safetensors) or
+        # mmapped (torch), and assigned to the model without another copy
+        # where the torch version supports it.
         if path.endswith('safetensors'):
-            from safetensors.torch import load_file as load_safetensors
-            sd = load_safetensors(path)
+            from safetensors import safe_open
+            map_device = device if device == 'cpu' else f'cuda:{device}'
+            with safe_open(path, framework='pt', device=map_device) as f:
+                ignored = {
+                    k
+                    for k in f.keys() if any(ik in k for ik in ignore_keys)
+                }
+                new_sd = {
+                    k: f.get_tensor(k)
+                    for k in f.keys() if k not in ignored
+                }
+        else:
+            sd = load_torch_checkpoint(path)
+            ignored = {k for k in sd if any(ik in k for ik in ignore_keys)}
+            new_sd = {k: v for k, v in sd.items() if k not in ignored}
+        if we.rank == 0 and self.logger.isEnabledFor(logging.DEBUG):
+            for k in ignored:
+                self.logger.debug('Ignore key %s from state_dict.', k)
+
+        # keep the parameter dtypes of the model when assigning
+        model_sd = model.state_dict()
+        for k, v in new_sd.items():
+            if k in model_sd and v.dtype != model_sd[k].dtype:
+                new_sd[k] = v.to(model_sd[k].dtype)
+        if _LOAD_STATE_ASSIGN:
+            missing, unexpected = model.load_state_dict(new_sd,
+                                                        strict=False,
+                                                        assign=True)
         else:
-            sd = torch.load(path, map_location='cpu')
-
-        new_sd = OrderedDict()
-        for k, v in sd.items():
-            ignored = False
-            for ik in ignore_keys:
-                if ik in k:
-                    if we.rank == 0:
-                        self.logger.info(
-                            'Ignore key {} from state_dict.'.format(k))
-                    ignored = True
-                    break
-            if not ignored:
-                new_sd[k] = v
-
-        missing, unexpected = model.load_state_dict(new_sd, strict=False)
+            missing, unexpected = model.load_state_dict(new_sd, strict=False)
         if we.rank == 0:
             self.logger.info(
                 f'Restored from {path} with {len(missing)} missing and {len(unexpected)} unexpected keys'
@@ -221,7 +332,10 @@ class DiffusionInference():
 
     def load(self, module):
         if module['device'] == 'offline':
-            if module['cfg'].NAME in MODELS.class_map:
+            compile_key = self.get_compile_key(module)
+            if compile_key in self._compile_cache:
+                model = self._compile_cache[compile_key]
+            elif module['cfg'].NAME in MODELS.class_map:
                 model = MODELS.build(module['cfg'], logger=self.logger).eval()
             elif module['cfg'].NAME in BACKBONES.class_map:
                 model = BACKBONES.build(module['cfg'],
@@ -231,31 +345,182 @@ class DiffusionInference():
                                         logger=self.logger).eval()
             else:
                 raise NotImplementedError
-            if module['cfg'].get('RELOAD_MODEL', None):
-                self.init_from_ckpt(module['cfg'].RELOAD_MODEL, model)
-            module['model'] = model
+            if module['cfg'].get('RELOAD_MODEL', None) and not hasattr(
+                    model, '_orig_mod'):
+                self.init_from_ckpt(module['cfg'].RELOAD_MODEL,
+                                    model,
+                                    device=we.device_id)
+            module['model'] = model.requires_grad_(False)
             module['device'] = 'cpu'
         if module['device'] == 'cpu':
             module['device'] = we.device_id
-            module['model'] = module['model'].to(we.device_id)
+            copy_stream = self.get_copy_stream()
+            if copy_stream is None:
+                module['model'] = model_to(module['model'], we.device_id)
+            else:
+                # issue the copy on a side stream so that it overlaps the
+                # kernels already queued, consumers wait on the ready event.
+                offload_event = module.pop('_offload_event', None)
+                if offload_event is not None:
+                    copy_stream.wait_event(offload_event)
+                with torch.cuda.stream(copy_stream):
+                    module['model'] = model_to(module['model'],
+                                               we.device_id,
+                                               non_blocking=True)
+                    module['_ready_event'] = copy_stream.record_event()
+                current_stream = torch.cuda.current_stream()
+                for t in itertools.chain(module['model'].parameters(),
+                                         module['model'].buffers()):
+                    if t.is_cuda:
+                        t.record_stream(current_stream)
+            if any(module['paras'].get(k, False)
+                   for k in ('channels_last', 'fp8', 'compile')):
+                self.wait_ready(module)
+            if module['paras'].get('channels_last', False):
+                module['model'] = module['model'].to(
+                    memory_format=torch.channels_last)
+            if module['paras'].get('fp8', False):
+                module['model'] = self.quantize_model(module)
+            if module['paras'].get('compile', False) and not hasattr(
+                    module['model'], '_orig_mod'):
+                module['model'] = self.compile_model(module)
         return module
 
-    def unload(self, module):
+    def get_copy_stream(self):
+        if self._copy_stream is None and torch.cuda.is_available(
+        ) and we.device_id != 'cpu':
+            self._copy_stream = torch.cuda.Stream(device=we.device_id)
+        return self._copy_stream
+
+    def wait_ready(self, *modules):
+        # order the current stream after the pending weights copies.
+        for module in modules:
+            event = module.pop('_ready_event', None) if module else None
+            if event is not None:
+                torch.cuda.current_stream().wait_event(event)
+
+    def quantize_model(self, module):
+        model = module['model']
+        if any(isinstance(m, FP8Linear) for m in model.modules()):
+            return model
+        if not fp8_is_available():
+            self.logger.warning(
+                'FP8 is not supported on this device, keep {} model in its '
+                'original precision.'.format(module['name']))
+            return model
+        converted = convert_feedforward_to_fp8(model)
+        self.logger.info('Quantize {} linears of {} model to fp8.'.format(
+            converted, module['name']))
+        return model
+
+    def get_compile_key(self, module):
+        # the input shapes are guarded by dynamo inside the compiled wrapper
+        if not module['paras'].get('compile', False):
+            return None
+        return hashlib.md5(module['cfg'].dump().encode()).hexdigest()
+
+    def compile_model(self, module):
+        compile_key = self.get_compile_key(module)
+        if compile_key in self._compile_cache:
+            return self._compile_cache[compile_key]
+        cache_dir = module['paras'].get('compile_cache_dir', None)
+        if cache_dir:
+            os.environ.setdefault('TORCHINDUCTOR_CACHE_DIR', cache_dir)
+        torch._dynamo.config.cache_size_limit = max(
+            torch._dynamo.config.cache_size_limit, 64)
+        backend = module['paras'].get('compile_backend', 'inductor')
+        model = module['model'].to(memory_format=torch.channels_last)
+        model = torch.compile(
+            model,
+            backend=backend,
+            mode='reduce-overhead' if backend == 'inductor' else None,
+            fullgraph=False,
+            dynamic=False)
+        self.warmup_model(model, module)
+        self._compile_cache[compile_key] = model
+        return model
+
+    def get_warmup_batch_size(self):
+        # the sampler concatenates the cond and uncond inputs with cat_uc
+        return 2 if getattr(self, 'input', {}).get('cat_uc', True) else 1
+
+    def get_warmup_cond(self, model, noise, cond):
+        # hook for the extra condition inputs the unet of a pipeline reads
+        return cond
+
+    def warmup_model(self, model, module):
+        # run one forward with dummy inputs shaped like the sampler's, so
+        # that the compile cost is paid before the first real call.
+        height, width = getattr(self, 'input',
+                                {}).get('target_size_as_tuple', [1024, 1024])
+        size_factor = self.first_stage_model['paras'].get('size_factor', 8)
+        batch_size = self.get_warmup_batch_size()
+        in_channels = getattr(model, 'in_channels', 4)
+        context_dim = getattr(model, 'context_dim', None)
+        adm_in_channels = getattr(model, 'adm_in_channels', None)
+        memory_format = torch.channels_last if module['paras'].get(
+            'channels_last', False) else torch.contiguous_format
+        noise = torch.randn(batch_size,
+                            4,
+                            height // size_factor,
+                            width // size_factor,
+                            device=we.device_id).contiguous(
+                                memory_format=memory_format)
+        cond = {}
+        if in_channels > 4:
+            cond['concat'] = torch.zeros(batch_size,
+                                         in_channels - 4,
+                                         *noise.shape[2:],
+                                         device=we.device_id)
+        if isinstance(context_dim, int):
+            cond['crossattn'] = torch.zeros(batch_size,
+                                            77,
+                                            context_dim,
+                                            device=we.device_id)
+        if adm_in_channels is not None:
+            cond['y'] = torch.zeros(batch_size,
+                                    adm_in_channels,
+                                    device=we.device_id)
+        cond = self.get_warmup_cond(model, noise, cond)
+        t = torch.zeros(batch_size, dtype=torch.long, device=we.device_id)
+        _, dtype = self.get_function_info(module)
+        with torch.inference_mode(), torch.autocast('cuda',
+                                                    enabled=dtype == 'float16',
+                                                    dtype=getattr(
+                                                        torch, dtype)):
+            model(noise, t=t, cond=cond)
+
+    def unload(self, module, force=False):
+        # force releases compiled models as well, e.g. when the whole
+        # pipeline is unloaded to free the gpu.
         if module is None:
             return module
         mem = get_available_memory()
         free_mem = int(mem['available'] / (1024**2))
         total_mem = int(mem['total'] / (1024**2))
-        if free_mem < 0.5 * total_mem:
+        compiled = hasattr(module['model'], '_orig_mod')
+        if free_mem < 0.5 * total_mem or (compiled and force):
+            if compiled:
+                # evict the compiled model as well, it is rebuilt and
+                # recompiled on the next load.
+                self._compile_cache.pop(self.get_compile_key(module), None)
             if module['model'] is not None:
-                module['model'] = module['model'].to('cpu')
+                self.wait_ready(module)
+                module['model'] = model_to(module['model'], 'cpu')
                 del module['model']
             module['model'] = None
+            module.pop('pinned', None)
+            module.pop('_offload_event', None)
             module['device'] = 'offline'
-            print('delete module')
+            self.logger.debug('Delete %s model', module['name'])
+        elif compiled:
+            # the cuda graphs captured by reduce-overhead hold the addresses
+            # of the parameters, so a compiled model stays on the device
+            # between the calls.
+            return module
         else:
             if module['model'] is not None:
-                module['model'] = module['model'].to('cpu')
+                module['model'] = self.offload_model(module)
                 module['device'] = 'cpu'
             else:
                 module['device'] = 'offline'
@@ -263,8 +528,35 @@ class DiffusionInference():
         torch.cuda.ipc_collect()
         return module
 
+    def offload_model(self, module):
+        # copy the weights into pinned host buffers kept by the module, so
+        # that the next load can be issued with non_blocking=True.
+        model = module['model']
+        if not torch.cuda.is_available():
+            return model_to(model, 'cpu')
+        self.wait_ready(module)
+        pinned = module.setdefault('pinned', {})
+        # the buffers may be created inside __call__, keep them inference
+        # tensors whoever unloads the module.
+        with torch.inference_mode():
+            for name, t in itertools.chain(model.named_parameters(),
+                                           model.named_buffers()):
+                if t.device.type != 'cuda':
+                    continue
+                # keep the strides, channels_last weights stay channels_last
+                buf = pinned.get(name, None)
+                if buf is None or (buf.shape, buf.dtype, buf.stride()) != (
+                        t.shape, t.dtype, t.stride()):
+                    pinned[name] = torch.empty_like(t,
+                                                    device='cpu',
+                                                    pin_memory=True)
+                pinned[name].copy_(t.data, non_blocking=True)
+                t.data = pinned[name]
+        module['_offload_event'] = torch.cuda.current_stream().record_event()
+        return model
+
     def dynamic_load(self, module=None, name=''):
-        self.logger.info('Loading {} model'.format(name))
+        self.logger.debug('Loading %s model', name)
         if name == 'all':
             for subname in self.loaded_model_name:
                 self.loaded_model[subname] = self.dynamic_load(
@@ -272,7 +564,7 @@ class DiffusionInference():
         elif name in self.loaded_model_name:
             if name in self.loaded_model:
                 if module['cfg'] != self.loaded_model[name]['cfg']:
-                    self.unload(self.loaded_model[name])
+                    self.unload(self.loaded_model[name], force=True)
                     module = self.load(module)
                     self.loaded_model[name] = module
                     return module
@@ -289,10 +581,10 @@ class DiffusionInference():
             return self.load(module)
 
     def dynamic_unload(self, module=None, name='', skip_loaded=False):
-        self.logger.info('Unloading {} model'.format(name))
+        self.logger.debug('Unloading %s model', name)
         if name == 'all':
             for name, module in self.loaded_model.items():
-                module = self.unload(self.loaded_model[name])
+                module = self.unload(self.loaded_model[name], force=True)
                 self.loaded_model[name] = module
         elif name in self.loaded_model_name:
             if name in self.loaded_model:
@@ -310,6 +602,9 @@ class DiffusionInference():
             self.paras = cfg.PARAS
             self.input = {k.lower(): v for k, v in cfg.INPUT.items()}
             self.output = {k.lower(): v for k, v in cfg.OUTPUT.items()}
+            # snapshots merged with the call inputs instead of deep copies
+            self._input_template = dict(self.input)
+            self._output_template = dict(self.output)
             module_paras = cfg.MODULES_PARAS
         return module_paras
 
@@ -343,56 +638,160 @@ class DiffusionInference():
     def get_batch(self, value_dict, num_samples=1):
         batch = {}
         batch_uc = {}
+        fields = []
         N = num_samples
-        device = we.device_id
         for key in value_dict:
             if key == 'prompt':
                 if not self.tokenizer:
                     batch['prompt'] = value_dict['prompt']
                     batch_uc['prompt'] = value_dict['negative_prompt']
                 else:
-                    batch['tokens'] = self.tokenizer(value_dict['prompt']).to(
-                        we.device_id)
-                    batch_uc['tokens'] = self.tokenizer(
-                        value_dict['negative_prompt']).to(we.device_id)
-            elif key == 'original_size_as_tuple':
-                batch['original_size_as_tuple'] = (torch.tensor(
-                    value_dict['original_size_as_tuple']).to(device).repeat(
-                        N, 1))
-            elif key == 'crop_coords_top_left':
-                batch['crop_coords_top_left'] = (torch.tensor(
-                    value_dict['crop_coords_top_left']).to(device).repeat(
-                        N, 1))
+                    batch['tokens'] = self.tokenize(value_dict['prompt'])
+                    batch_uc['tokens'] = self.tokenize(
+                        value_dict['negative_prompt'])
+            elif key in ('original_size_as_tuple', 'crop_coords_top_left',
+                         'target_size_as_tuple'):
+                batch[key] = None
+                fields.append((batch, key, value_dict[key]))
             elif key == 'aesthetic_score':
-                batch['aesthetic_score'] = (torch.tensor(
-                    [value_dict['aesthetic_score']]).to(device).repeat(N, 1))
-                batch_uc['aesthetic_score'] = (torch.tensor([
-                    value_dict['negative_aesthetic_score']
-                ]).to(device).repeat(N, 1))
-
-            elif key == 'target_size_as_tuple':
-                batch['target_size_as_tuple'] = (torch.tensor(
-                    value_dict['target_size_as_tuple']).to(device).repeat(
-                        N, 1))
+                batch[key] = batch_uc[key] = None
+                fields.append((batch, key, [value_dict['aesthetic_score']]))
+                fields.append(
+                    (batch_uc, key, [value_dict['negative_aesthetic_score']]))
             elif key == 'image':
-                batch[key] = self.load_image(value_dict[key], num_samples=N)
+                # no condition reads the image, the image2image branch of
+                # __call__ loads it only when it is used.
+                continue
             else:
                 batch[key] = value_dict[key]
+        self.fill_batch_tensors(fields, num_samples=N)
 
+        # the tensors are only read by the condition models, share them.
         for key in batch.keys():
             if key not in batch_uc and isinstance(batch[key], torch.Tensor):
-                batch_uc[key] = torch.clone(batch[key])
+                batch_uc[key] = batch[key]
         return batch, batch_uc
 
+    def _tokenize(self, prompts):
+        tokens = self.tokenizer(list(prompts))
+        if torch.cuda.is_available():
+            tokens = tokens.pin_memory()
+        return tokens
+
+    def tokenize(self, prompt):
+        # the tokens of a prompt are cached as pinned host tensors, so only
+        # an asynchronous upload is left on the hot path.
+        prompts = tuple(prompt) if isinstance(prompt,
+                                              (list, tuple)) else (prompt, )
+        return self._tokenize_cached(prompts).to(we.device_id,
+                                                 non_blocking=True)
+
+    def fill_batch_tensors(self, fields, num_samples=1):
+        # gather the small metadata values into one pinned host tensor, so
+        # that a single host to device copy is issued for the whole batch.
+        if len(fields) < 1:
+            return
+        host = torch.tensor([x for _, _, values in fields for x in values],
+                            dtype=torch.float64)
+        if torch.cuda.is_available():
+            host = host.pin_memory()
+        device_values = host.to(we.device_id, non_blocking=True)
+        start = 0
+        for target, key, values in fields:
+            dtype = torch.float32 if any(
+                isinstance(x, float) for x in values) else torch.int64
+            target[key] = device_values[start:start + len(values)].to(
+                dtype).unsqueeze(0).expand(num_samples, -1)
+            start += len(values)
+
+    def get_norm_tensors(self, mean, std):
+        # normalize constants are kept on the device and reused across calls
+        key = (tuple(mean), tuple(std))
+        if key not in self._norm_cache:
+            mean = torch.tensor(mean, device=we.device_id).view(1, -1, 1, 1)
+            std = torch.tensor(std, device=we.device_id).view(1, -1, 1, 1)
+            self._norm_cache[key] = (mean, std)
+        return self._norm_cache[key]
+
+    def images_to_tensor(self,
+                         images,
+                         height,
+                         width,
+                         mean=(0.5, 0.5, 0.5),
+                         std=(0.5, 0.5, 0.5),
+                         keep_ratio=True):
+        """
+        Upload PIL images as uint8 and resize, crop and normalize them on the
+        device. Images of the same size are uploaded and resized as one batch.
+        :param images: a list of PIL images.
+        :param height: the output height.
+        :param width: the output width.
+        :param mean: the normalize mean.
+        :param std: the normalize std.
+        :param keep_ratio: resize to cover the output size then center crop,
+            otherwise resize to the output size directly.
+        :return: a float tensor of shape (N, 3, height, width).
+        """
+        arrays = [np.asarray(img.convert('RGB')) for img in images]
+        if all(arr.shape == arrays[0].shape for arr in arrays):
+            groups = [np.stack(arrays)]
+        else:
+            groups = [arr[None] for arr in arrays]
+        tensors = []
+        for group in groups:
+            x = torch.from_numpy(group)
+            if torch.cuda.is_available():
+                x = x.pin_memory()
+            x = x.to(we.device_id, non_blocking=True)
+            x = x.permute(0, 3, 1, 2).float().div_(255.)
+            h, w = x.shape[-2:]
+            if not (h == height and w == width):
+                if keep_ratio:
+                    scale = max(width / w, height / h)
+                    new_h, new_w = int(h * scale), int(w * scale)
+                else:
+                    new_h, new_w = height, width
+                x = F.interpolate(x,
+                                  size=(new_h, new_w),
+                                  mode='bicubic',
+                                  antialias=True).clamp_(0, 1)
+                top = int(round((new_h - height) / 2.))
+                left = int(round((new_w - width) / 2.))
+                x = x[:, :, top:top + height, left:left + width]
+            tensors.append(x)
+        x = torch.cat(tensors) if len(tensors) > 1 else tensors[0]
+        mean, std = self.get_norm_tensors(mean, std)
+        return x.sub_(mean).div_(std)
+
     def load_image(self, image, num_samples=1):
-        if isinstance(image, torch.Tensor):
-            pass
-        elif isinstance(image, Image):
-            pass
+        if isinstance(image, (list, tuple)) and len(image) > 0:
+            if all(isinstance(img, torch.Tensor) for img in image):
+                image = torch.stack(image)
+            elif all(isinstance(img, Image) for img in image):
+                image = self.images_to_tensor(image, image[0].height,
+                                              image[0].width)
         elif isinstance(image, Image):
-            pass
+            image = self.images_to_tensor([image], image.height, image.width)
+        if not isinstance(image, torch.Tensor):
+            return image
+        if image.device != torch.device(we.device_id):
+            image = image.to(we.device_id, non_blocking=True)
+        if image.dim() == 3:
+            image = image.unsqueeze(0)
+        if image.shape[0] == 1 and num_samples > 1:
+            image = image.expand(num_samples, -1, -1, -1)
+        return image
 
     def get_function_info(self, module, function_name=None):
+        # the function info of a module is fixed once it is inferred, so the
+        # lookup is memoized in the module itself.
+        cache = module.setdefault('_cached_function_info', {})
+        if function_name not in cache:
+            cache[function_name] = self._get_function_info(
+                module, function_name)
+        return cache[function_name]
+
+    def _get_function_info(self, module, function_name=None):
         all_function = module['function_info']
         if function_name in all_function:
             return function_name, all_function[function_name]['dtype']
@@ -400,12 +799,17 @@ class DiffusionInference():
             for k, v in all_function.items():
                 return k, v['dtype']
 
-    def encode_first_stage(self, x, **kwargs):
+    def encode_first_stage(self, x, scale=True, **kwargs):
         _, dtype = self.get_function_info(self.first_stage_model, 'encode')
         with torch.autocast('cuda',
                             enabled=dtype == 'float16',
                             dtype=getattr(torch, dtype)):
+            self.wait_ready(self.first_stage_model)
+            if self.first_stage_model['paras'].get('channels_last', False):
+                x = x.contiguous(memory_format=torch.channels_last)
             z = get_model(self.first_stage_model).encode(x)
+            if not scale:
+                return z
             return self.first_stage_model['paras']['scale_factor'] * z
 
     def decode_first_stage(self, z):
@@ -413,10 +817,11 @@ class DiffusionInference():
         with torch.autocast('cuda',
                             enabled=dtype == 'float16',
                             dtype=getattr(torch, dtype)):
-            z = 1. / self.first_stage_model['paras']['scale_factor'] * z
+            self.wait_ready(self.first_stage_model)
+            z = self.first_stage_model['paras']['inv_scale_factor'] * z
             return get_model(self.first_stage_model).decode(z)
 
-    @torch.no_grad()
+    @torch.inference_mode()
     def __call__(self,
                  input,
                  num_samples=1,
@@ -428,11 +833,12 @@ class DiffusionInference():
                  control_model=None,
                  **kwargs):
 
-        value_input = copy.deepcopy(self.input)
-        value_input.update(input)
-        print(value_input)
+        value_input = {**self._input_template, **input}
         height, width = value_input['target_size_as_tuple']
-        value_output = copy.deepcopy(self.output)
+        value_output = {
+            k: ([] if isinstance(v, list) else v)
+            for k, v in self._output_template.items()
+        }
         batch, batch_uc = self.get_batch(value_input, num_samples=1)
 
         # register tuner
@@ -442,6 +848,7 @@ class DiffusionInference():
                 tuner_model = [tuner_model]
             self.dynamic_load(self.diffusion_model, 'diffusion_model')
             self.dynamic_load(self.cond_stage_model, 'cond_stage_model')
+            self.wait_ready(self.diffusion_model, self.cond_stage_model)
             self.tuner_infer.register_tuner(tuner_model, self.diffusion_model,
                                             self.cond_stage_model)
             self.dynamic_unload(self.diffusion_model,
@@ -454,6 +861,7 @@ class DiffusionInference():
         # register control
         if control_model is not None and control_model != '':
             self.dynamic_load(self.diffusion_model, 'diffusion_model')
+            self.wait_ready(self.diffusion_model)
             hints = ControlInference.get_control_input(
                 control_model, kwargs.pop('control_cond_image', None), height,
                 width)
@@ -469,6 +877,7 @@ class DiffusionInference():
         image = input.pop('image', None)
         if image is not None and img_to_img_strength > 0:
             # run image2image
+            image = self.load_image(image)
             b, c, ori_width, ori_height = image.shape
             if not (ori_width == width and ori_height == height):
                 image = F.interpolate(image, (width, height), mode='bicubic')
@@ -481,8 +890,12 @@ class DiffusionInference():
             input_latent = None
         if 'input_latent' in value_output and input_latent is not None:
             value_output['input_latent'] = input_latent
-        # cond stage
+        # cond stage, after an image2image encode the weights copy is issued
+        # on the copy stream right after the asynchronous vae encode is
+        # dispatched, so it overlaps the encode still running on the current
+        # stream.
         self.dynamic_load(self.cond_stage_model, 'cond_stage_model')
+        self.wait_ready(self.cond_stage_model)
         function_name, dtype = self.get_function_info(self.cond_stage_model)
         with torch.autocast('cuda',
                             enabled=dtype == 'float16',
@@ -508,6 +921,7 @@ class DiffusionInference():
         if refine_strength > 0 and self.refiner_diffusion_model is not None:
             assert self.refiner_cond_model is not None
             self.refiner_cond_model = self.load(self.refiner_cond_model)
+            self.wait_ready(self.refiner_cond_model)
             function_name, dtype = self.get_function_info(
                 self.refiner_cond_model)
             with torch.autocast('cuda',
@@ -536,22 +950,38 @@ class DiffusionInference():
         g.manual_seed(seed)
         if 'seed' in value_output:
             value_output['seed'] = seed
-        for sample_id in range(num_samples):
-            if self.diffusion_model is not None:
-                noise = torch.empty(
-                    1,
-                    4,
-                    height // self.first_stage_model['paras']['size_factor'],
-                    width // self.first_stage_model['paras']['size_factor'],
-                    device=we.device_id).normal_(generator=g)
-
-                self.dynamic_load(self.diffusion_model, 'diffusion_model')
-                # UNet use input n_prompt
-                function_name, dtype = self.get_function_info(
-                    self.diffusion_model)
-                with torch.autocast('cuda',
-                                    enabled=dtype == 'float16',
-                                    dtype=getattr(torch, dtype)):
+        model_kwargs = [{
+            'cond': context,
+            'hint': hints
+        }, {
+            'cond': null_context,
+            'hint': hints
+        }]
+        # the latent shape is fixed, refill the same noise buffer per sample.
+        # the buffer is filled contiguous so that a seed gives the same noise
+        # whatever memory format the unet runs in.
+        size_factor = self.first_stage_model['paras']['size_factor']
+        memory_format = torch.channels_last if self.diffusion_model[
+            'paras'].get('channels_last', False) else torch.contiguous_format
+        noise_buf = torch.empty(1,
+                                4,
+                                height // size_factor,
+                                width // size_factor,
+                                device=we.device_id)
+        _, dm_dtype = self.get_function_info(self.diffusion_model)
+        dm_torch_dtype = getattr(torch, dm_dtype)
+        dm_enable_ac = dm_dtype == 'float16'
+        with torch.autocast('cuda',
+                            enabled=dm_enable_ac,
+                            dtype=dm_torch_dtype):
+            for sample_id in range(num_samples):
+                if self.diffusion_model is not None:
+                    noise = noise_buf.normal_(generator=g).contiguous(
+                        memory_format=memory_format)
+
+                    self.dynamic_load(self.diffusion_model, 'diffusion_model')
+                    self.wait_ready(self.diffusion_model)
+                    # UNet use input n_prompt
                     latent = self.diffusion.sample(
                         noise=noise,
                         x=input_latent,
@@ -560,13 +990,7 @@ class DiffusionInference():
                         refine_strength=refine_strength,
                         solver=value_input.get('sample', 'ddim'),
                         model=get_model(self.diffusion_model),
-                        model_kwargs=[{
-                            'cond': context,
-                            'hint': hints
-                        }, {
-                            'cond': null_context,
-                            'hint': hints
-                        }],
+                        model_kwargs=model_kwargs,
                         steps=value_input.get('sample_steps', 50),
                         guide_scale=value_input.get('guide_scale', 7.5),
                         guide_rescale=value_input.get('guide_rescale', 0.5),
@@ -585,88 +1009,94 @@ class DiffusionInference():
                         cat_uc=value_input.get('cat_uc', cat_uc),
                         **kwargs)
 
-                self.dynamic_unload(self.diffusion_model,
-                                    'diffusion_model',
-                                    skip_loaded=True)
+                    self.dynamic_unload(self.diffusion_model,
+                                        'diffusion_model',
+                                        skip_loaded=True)
+
+                # apply refiner
+                if (refine_strength > 0
+                        and self.refiner_diffusion_model is not None):
+                    assert self.refiner_diffusion_model is not None
+                    # decode intermidiet latent before refine
+                    self.first_stage_model = self.load(
+                        self.first_stage_model)
+                    before_refiner_samples = self.decode_first_stage(latent)
+                    self.first_stage_model = self.unload(
+                        self.first_stage_model)
 
-            # apply refiner
-            if refine_strength > 0 and self.refiner_diffusion_model is not None:
-                assert self.refiner_diffusion_model is not None
-                # decode intermidiet latent before refine
-                self.first_stage_model = self.load(self.first_stage_model)
-                before_refiner_samples = self.decode_first_stage(
-                    latent).float()
-                self.first_stage_model = self.unload(self.first_stage_model)
-
-                before_refiner_samples = torch.clamp(
-                    (before_refiner_samples + 1.0) / 2.0, min=0.0, max=1.0)
-                if 'before_refine_images' in value_output:
-                    if value_output['before_refine_images'] is None or (
-                            isinstance(value_output['before_refine_images'],
-                                       list)
-                            and len(value_output['before_refine_images']) < 1):
-                        value_output['before_refine_images'] = []
-                    value_output['before_refine_images'].append(
+                    before_refiner_samples = samples_to_images(
                         before_refiner_samples)
-                self.refiner_model = self.load(self.refiner_diffusion_model)
-                function_name, dtype = self.get_function_info(
-                    self.refiner_model)
-                with torch.autocast('cuda',
-                                    enabled=dtype == 'float16',
-                                    dtype=getattr(torch, dtype)):
-                    latent = self.diffusion.sample(
-                        noise=noise,
-                        x=latent,
-                        denoising_strength=img_to_img_strength
-                        if input_latent is not None else 1.0,
-                        refine_strength=refine_strength,
-                        refine_stage=True,
-                        solver=value_input.get('refine_sample', 'ddim'),
-                        model=get_model(self.refiner_model),
-                        model_kwargs=[{
-                            'cond': refine_context
-                        }, {
-                            'cond': refine_null_context
-                        }],
-                        steps=value_input.get('refine_sample_steps', 50),
-                        guide_scale=value_input.get('refine_guide_scale', 7.5),
-                        guide_rescale=value_input.get('refine_guide_rescale',
-                                                      0.5),
-                        discretization=value_input.get('refine_discretization',
-                                                       'trailing'),
-                        show_progress=True,
-                        seed=seed,
-                        condition_fn=None,
-                        clamp=None,
-                        percentile=None,
-                        t_max=None,
-                        t_min=None,
-                        discard_penultimate_step=None,
-                        return_intermediate=None,
-                        intermediate_callback=intermediate_callback,
-                        cat_uc=cat_uc,
-                        **kwargs)
-                self.refiner_model = self.unload(self.refiner_model)
+                    if 'before_refine_images' in value_output:
+                        before_refine_images = value_output[
+                            'before_refine_images']
+                        if before_refine_images is None or (
+                                isinstance(before_refine_images, list)
+                                and len(before_refine_images) < 1):
+                            value_output['before_refine_images'] = []
+                        value_output['before_refine_images'].append(
+                            before_refiner_samples)
+                    self.refiner_model = self.load(
+                        self.refiner_diffusion_model)
+                    self.wait_ready(self.refiner_model)
+                    function_name, dtype = self.get_function_info(
+                        self.refiner_model)
+                    with torch.autocast('cuda',
+                                        enabled=dtype == 'float16',
+                                        dtype=getattr(torch, dtype)):
+                        latent = self.diffusion.sample(
+                            noise=noise,
+                            x=latent,
+                            denoising_strength=img_to_img_strength
+                            if input_latent is not None else 1.0,
+                            refine_strength=refine_strength,
+                            refine_stage=True,
+                            solver=value_input.get('refine_sample', 'ddim'),
+                            model=get_model(self.refiner_model),
+                            model_kwargs=[{
+                                'cond': refine_context
+                            }, {
+                                'cond': refine_null_context
+                            }],
+                            steps=value_input.get('refine_sample_steps', 50),
+                            guide_scale=value_input.get(
+                                'refine_guide_scale', 7.5),
+                            guide_rescale=value_input.get(
+                                'refine_guide_rescale', 0.5),
+                            discretization=value_input.get(
+                                'refine_discretization', 'trailing'),
+                            show_progress=True,
+                            seed=seed,
+                            condition_fn=None,
+                            clamp=None,
+                            percentile=None,
+                            t_max=None,
+                            t_min=None,
+                            discard_penultimate_step=None,
+                            return_intermediate=None,
+                            intermediate_callback=intermediate_callback,
+                            cat_uc=cat_uc,
+                            **kwargs)
+                    self.refiner_model = self.unload(self.refiner_model)
 
-            if 'latent' in value_output:
-                if value_output['latent'] is None or (
-                        isinstance(value_output['latent'], list)
-                        and len(value_output['latent']) < 1):
-                    value_output['latent'] = []
-                value_output['latent'].append(latent)
+                if 'latent' in value_output:
+                    if value_output['latent'] is None or (
+                            isinstance(value_output['latent'], list)
+                            and len(value_output['latent']) < 1):
+                        value_output['latent'] = []
+                    value_output['latent'].append(latent)
 
-            self.dynamic_load(self.first_stage_model, 'first_stage_model')
-            x_samples = self.decode_first_stage(latent).float()
-            self.dynamic_unload(self.first_stage_model,
-                                'first_stage_model',
-                                skip_loaded=True)
-            images = torch.clamp((x_samples + 1.0) / 2.0, min=0.0, max=1.0)
-            if 'images' in value_output:
-                if value_output['images'] is None or (
-                        isinstance(value_output['images'], list)
-                        and len(value_output['images']) < 1):
-                    value_output['images'] = []
-                value_output['images'].append(images)
+                self.dynamic_load(self.first_stage_model, 'first_stage_model')
+                x_samples = self.decode_first_stage(latent)
+                self.dynamic_unload(self.first_stage_model,
+                                    'first_stage_model',
+                                    skip_loaded=True)
+                images = samples_to_images(x_samples)
+                if 'images' in value_output:
+                    if value_output['images'] is None or (
+                            isinstance(value_output['images'], list)
+                            and len(value_output['images']) < 1):
+                        value_output['images'] = []
+                    value_output['images'].append(images)
 
         for k, v in value_output.items():
             if isinstance(v, list):
@@ -1,18 +1,15 @@
 # -*- coding: utf-8 -*-
 # Copyright (c) Alibaba, Inc. and its affiliates.
 import copy
-import os.path
 import random
-from collections import OrderedDict
 
 import gradio as gr
 import torch
 import torchvision.transforms.functional as TF
 from scepter.modules.model.utils.data_utils import crop_back
 from scepter.modules.utils.distribute import we
-from scepter.modules.utils.file_system import FS
 
-from .diffusion_inference import DiffusionInference
+from .diffusion_inference import DiffusionInference, samples_to_images
 
 
 def get_model(model_tuple):
@@ -27,96 +24,25 @@ class LargenInference(DiffusionInference):
         create and load model when run this model at the first time.
     '''
     def __init__(self, logger=None):
-        self.logger = logger
-        self.loaded_model = {}
-        self.loaded_model_name = [
-            'diffusion_model', 'first_stage_model', 'cond_stage_model'
-        ]
-
-    def redefine_paras(self, cfg):
-        if cfg.get('PRETRAINED_MODEL', None):
-            assert FS.isfile(cfg.PRETRAINED_MODEL)
-            with FS.get_from(cfg.PRETRAINED_MODEL,
-                             wait_finish=True) as local_path:
-                if local_path.endswith('safetensors'):
-                    from safetensors.torch import load_file as load_safetensors
-                    sd = load_safetensors(local_path)
-                else:
-                    sd = torch.load(local_path, map_location='cpu')
-
-                if 'model' in sd:
-                    sd = sd['model']
-
-                first_stage_model_path = os.path.join(
-                    os.path.dirname(local_path), 'first_stage_model.pth')
-                cond_stage_model_path = os.path.join(
-                    os.path.dirname(local_path), 'cond_stage_model.pth')
-                diffusion_model_path = os.path.join(
-                    os.path.dirname(local_path), 'diffusion_model.pth')
-                if (not os.path.exists(first_stage_model_path)
-                        or not os.path.exists(cond_stage_model_path)
-                        or not os.path.exists(diffusion_model_path)):
-                    self.logger.info(
-                        'Now read the whole model and rearrange the modules, it may take several mins.'
-                    )
-                    first_stage_model = OrderedDict()
-                    cond_stage_model = OrderedDict()
-                    diffusion_model = OrderedDict()
-                    for k, v in sd.items():
-                        if k.startswith('first_stage_model.'):
-                            first_stage_model[k.replace(
-                                'first_stage_model.', '')] = v
-                        elif k.startswith('conditioner.'):
-                            cond_stage_model[k.replace('conditioner.', '')] = v
-                        elif k.startswith('cond_stage_model.'):
-                            if k.startswith('cond_stage_model.model.'):
-                                cond_stage_model[k.replace(
-                                    'cond_stage_model.model.', '')] = v
-                            else:
-                                cond_stage_model[k.replace(
-                                    'cond_stage_model.', '')] = v
-                        elif k.startswith('model.diffusion_model.'):
-                            diffusion_model[k.replace('model.diffusion_model.',
-                                                      '')] = v
-                        elif k.startswith('model.'):
-                            diffusion_model[k.replace('model.', '')] = v
-                        else:
-                            continue
-                    if cfg.have('FIRST_STAGE_MODEL'):
-                        with open(first_stage_model_path + 'cache', 'wb') as f:
-                            torch.save(first_stage_model, f)
-                        os.rename(first_stage_model_path + 'cache',
-                                  first_stage_model_path)
-                        self.logger.info(
-                            'First stage model has been processed.')
-                    if cfg.have('COND_STAGE_MODEL'):
-                        with open(cond_stage_model_path + 'cache', 'wb') as f:
-                            torch.save(cond_stage_model, f)
-                        os.rename(cond_stage_model_path + 'cache',
-                                  cond_stage_model_path)
-                        self.logger.info(
-                            'Cond stage model has been processed.')
-                    if cfg.have('DIFFUSION_MODEL'):
-                        with open(diffusion_model_path + 'cache', 'wb') as f:
-                            torch.save(diffusion_model, f)
-                        os.rename(diffusion_model_path + 'cache',
-                                  diffusion_model_path)
-                        self.logger.info('Diffusion model has been processed.')
-                if not cfg.FIRST_STAGE_MODEL.get('PRETRAINED_MODEL', None):
-                    cfg.FIRST_STAGE_MODEL.PRETRAINED_MODEL = first_stage_model_path
-                else:
-                    cfg.FIRST_STAGE_MODEL.RELOAD_MODEL = first_stage_model_path
-                if not cfg.COND_STAGE_MODEL.get('PRETRAINED_MODEL', None):
-                    cfg.COND_STAGE_MODEL.PRETRAINED_MODEL = cond_stage_model_path
-                else:
-                    cfg.COND_STAGE_MODEL.RELOAD_MODEL = cond_stage_model_path
-                if not cfg.DIFFUSION_MODEL.get('PRETRAINED_MODEL', None):
-                    cfg.DIFFUSION_MODEL.PRETRAINED_MODEL = diffusion_model_path
-                else:
-                    cfg.DIFFUSION_MODEL.RELOAD_MODEL = diffusion_model_path
-        return cfg
-
-    @torch.no_grad()
+        super().__init__(logger=logger)
+
+    def get_warmup_cond(self, model, noise, cond):
+        # the largen unet always reads the task, warm up the default one
+        cond['task'] = 'Text_Guided_Inpainting'
+        if getattr(model, 'use_refine', False):
+            cond['ref_xt'] = torch.zeros_like(noise)
+            cond['ref_crossattn'] = cond['crossattn']
+            cond['null_y'] = cond['y']
+        return cond
+
+    def split_state_key(self, key):
+        # the largen checkpoints keep the unet keys under model. as well
+        name, new_k = super().split_state_key(key)
+        if name is None and key.startswith('model.'):
+            return 'diffusion_model', key[len('model.'):]
+        return name, new_k
+
+    @torch.inference_mode()
     def __call__(self,
                  input,
                  num_samples=1,
@@ -131,11 +57,12 @@ class LargenInference(DiffusionInference):
         if not largen_state:
             raise gr.Error('LARGEN model must be used with LAR-Gen settings')
 
-        value_input = copy.deepcopy(self.input)
-        value_input.update(input)
-        print(value_input)
+        value_input = {**self._input_template, **input}
         height, width = value_input['target_size_as_tuple']
-        value_output = copy.deepcopy(self.output)
+        value_output = {
+            k: ([] if isinstance(v, list) else v)
+            for k, v in self._output_template.items()
+        }
         batch, batch_uc = self.get_batch(value_input, num_samples=1)
 
         # first stage encode
@@ -205,6 +132,7 @@ class LargenInference(DiffusionInference):
 
         # cond stage
         self.dynamic_load(self.cond_stage_model, 'cond_stage_model')
+        self.wait_ready(self.cond_stage_model)
         function_name, dtype = self.get_function_info(self.cond_stage_model)
         with torch.autocast('cuda',
                             enabled=dtype == 'float16',
@@ -225,22 +153,31 @@ class LargenInference(DiffusionInference):
         g.manual_seed(seed)
         if 'seed' in value_output:
             value_output['seed'] = seed
-        for sample_id in range(num_samples):
-            if self.diffusion_model is not None:
-                noise = torch.empty(
-                    1,
-                    4,
-                    height // self.first_stage_model['paras']['size_factor'],
-                    width // self.first_stage_model['paras']['size_factor'],
-                    device=we.device_id).normal_(generator=g)
-
-                self.dynamic_load(self.diffusion_model, 'diffusion_model')
-                # UNet use input n_prompt
-                function_name, dtype = self.get_function_info(
-                    self.diffusion_model)
-                with torch.autocast('cuda',
-                                    enabled=dtype == 'float16',
-                                    dtype=getattr(torch, dtype)):
+        # the latent shape is fixed, refill the same noise buffer per sample.
+        # the buffer is filled contiguous so that a seed gives the same noise
+        # whatever memory format the unet runs in.
+        size_factor = self.first_stage_model['paras']['size_factor']
+        memory_format = torch.channels_last if self.diffusion_model[
+            'paras'].get('channels_last', False) else torch.contiguous_format
+        noise_buf = torch.empty(1,
+                                4,
+                                height // size_factor,
+                                width // size_factor,
+                                device=we.device_id)
+        _, dm_dtype = self.get_function_info(self.diffusion_model)
+        dm_torch_dtype = getattr(torch, dm_dtype)
+        dm_enable_ac = dm_dtype == 'float16'
+        with torch.autocast('cuda',
+                            enabled=dm_enable_ac,
+                            dtype=dm_torch_dtype):
+            for sample_id in range(num_samples):
+                if self.diffusion_model is not None:
+                    noise = noise_buf.normal_(generator=g).contiguous(
+                        memory_format=memory_format)
+
+                    self.dynamic_load(self.diffusion_model, 'diffusion_model')
+                    self.wait_ready(self.diffusion_model)
+                    # UNet use input n_prompt
                     latent = self.diffusion.sample(
                         noise=noise,
                         x=None,
@@ -270,36 +207,36 @@ class LargenInference(DiffusionInference):
                         cat_uc=cat_uc,
                         **kwargs)
 
-                self.dynamic_unload(self.diffusion_model,
-                                    'diffusion_model',
-                                    skip_loaded=True)
-
-            if 'latent' in value_output:
-                if value_output['latent'] is None or (
-                        isinstance(value_output['latent'], list)
-                        and len(value_output['latent']) < 1):
-                    value_output['latent'] = []
-                value_output['latent'].append(latent)
-
-            self.dynamic_load(self.first_stage_model, 'first_stage_model')
-            x_samples = self.decode_first_stage(latent).float()
-            self.dynamic_unload(self.first_stage_model,
-                                'first_stage_model',
-                                skip_loaded=False)
-            images = torch.clamp((x_samples + 1.0) / 2.0, min=0.0, max=1.0)
-            if base_image is not None:
-                stitch_images = []
-                for img in images:
-                    stitch_img = crop_back(img, copy.deepcopy(base_image),
-                                           extra_sizes, bbox_yyxx)
-                    stitch_images.append(stitch_img)
-                images = torch.stack(stitch_images, dim=0)
-            if 'images' in value_output:
-                if value_output['images'] is None or (
-                        isinstance(value_output['images'], list)
-                        and len(value_output['images']) < 1):
-                    value_output['images'] = []
-                value_output['images'].append(images)
+                    self.dynamic_unload(self.diffusion_model,
+                                        'diffusion_model',
+                                        skip_loaded=True)
+
+                if 'latent' in value_output:
+                    if value_output['latent'] is None or (
+                            isinstance(value_output['latent'], list)
+                            and len(value_output['latent']) < 1):
+                        value_output['latent'] = []
+                    value_output['latent'].append(latent)
+
+                self.dynamic_load(self.first_stage_model, 'first_stage_model')
+                x_samples = self.decode_first_stage(latent)
+                self.dynamic_unload(self.first_stage_model,
+                                    'first_stage_model',
+                                    skip_loaded=False)
+                images = samples_to_images(x_samples)
+                if base_image is not None:
+                    stitch_images = []
+                    for img in images:
+                        stitch_img = crop_back(img, copy.deepcopy(base_image),
+                                               extra_sizes, bbox_yyxx)
+                        stitch_images.append(stitch_img)
+                    images = torch.stack(stitch_images, dim=0)
+                if 'images' in value_output:
+                    if value_output['images'] is None or (
+                            isinstance(value_output['images'], list)
+                            and len(value_output['images']) < 1):
+                        value_output['images'] = []
+                    value_output['images'].append(images)
 
         for k, v in value_output.items():
             if isinstance(v, list):
@@ -1,17 +1,13 @@
 # -*- coding: utf-8 -*-
 # Copyright (c) Alibaba, Inc. and its affiliates.
-import copy
 import random
 
 import gradio as gr
 import torch
 import torch.nn.functional as F
-import torchvision.transforms.functional as TF
 from scepter.modules.utils.distribute import we
 
-from .control_inference import ControlInference
-from .diffusion_inference import DiffusionInference
-from .tuner_inference import TunerInference
+from .diffusion_inference import DiffusionInference, samples_to_images
 
 
 def get_model(model_tuple):
@@ -26,53 +22,55 @@ class StyleboothInference(DiffusionInference):
         create and load model when run this model at the first time.
     '''
     def __init__(self, logger=None):
-        self.logger = logger
-        self.loaded_model = {}
-        self.loaded_model_name = [
-            'diffusion_model', 'first_stage_model', 'cond_stage_model'
-        ]
-        self.tuner_infer = TunerInference(self.logger)
-        self.control_infer = ControlInference(self.logger)
+        super().__init__(logger=logger)
+        self._zeros_cache = {}
+
+    def get_warmup_batch_size(self):
+        # the text and image guidance runs the cond, mid and uncond inputs
+        # one by one
+        return 1
 
     def get_batch(self, value_dict, num_samples=1):
         batch = {}
         batch_uc = {}
+        fields = []
         N = num_samples
-        device = we.device_id
         for key in value_dict:
             if key == 'prompt':
                 batch['prompt'] = value_dict['prompt']
                 batch_uc['prompt'] = value_dict['negative_prompt']
-            elif key == 'original_size_as_tuple':
-                batch['original_size_as_tuple'] = (torch.tensor(
-                    value_dict['original_size_as_tuple']).to(device).repeat(
-                        N, 1))
-            elif key == 'crop_coords_top_left':
-                batch['crop_coords_top_left'] = (torch.tensor(
-                    value_dict['crop_coords_top_left']).to(device).repeat(
-                        N, 1))
+            elif key in ('original_size_as_tuple', 'crop_coords_top_left',
+                         'target_size_as_tuple'):
+                batch[key] = None
+                fields.append((batch, key, value_dict[key]))
             elif key == 'aesthetic_score':
-                batch['aesthetic_score'] = (torch.tensor(
-                    [value_dict['aesthetic_score']]).to(device).repeat(N, 1))
-                batch_uc['aesthetic_score'] = (torch.tensor([
-                    value_dict['negative_aesthetic_score']
-                ]).to(device).repeat(N, 1))
-
-            elif key == 'target_size_as_tuple':
-                batch['target_size_as_tuple'] = (torch.tensor(
-                    value_dict['target_size_as_tuple']).to(device).repeat(
-                        N, 1))
+                batch[key] = batch_uc[key] = None
+                fields.append((batch, key, [value_dict['aesthetic_score']]))
+                fields.append(
+                    (batch_uc, key, [value_dict['negative_aesthetic_score']]))
             elif key == 'image':
-                batch[key] = self.load_image(value_dict[key], num_samples=N)
+                # no condition reads the image, the image2image branch of
+                # __call__ loads it only when it is used.
+                continue
             else:
                 batch[key] = value_dict[key]
+        self.fill_batch_tensors(fields, num_samples=N)
 
+        # the tensors are only read by the condition models, share them.
         for key in batch.keys():
             if key not in batch_uc and isinstance(batch[key], torch.Tensor):
-                batch_uc[key] = torch.clone(batch[key])
+                batch_uc[key] = batch[key]
         return batch, batch_uc
 
+    def get_zeros_like(self, x):
+        # the zero concat condition is only read by the unet, reuse it
+        key = (tuple(x.shape), x.dtype, x.device)
+        if key not in self._zeros_cache:
+            self._zeros_cache[key] = torch.zeros_like(x)
+        return self._zeros_cache[key]
+
     def encode_condition(self, data, data2=None, type='text'):
+        self.wait_ready(self.cond_stage_model)
         cond_stage_model = get_model(self.cond_stage_model)
         assert hasattr(self, 'tokenizer')
         with torch.autocast(device_type='cuda', enabled=False):
@@ -80,37 +78,48 @@ class StyleboothInference(DiffusionInference):
                     hasattr(cond_stage_model, 'build_new_tokens')
                     and not hasattr(cond_stage_model, 'new_tokens_to_ids')):
                 cond_stage_model.build_new_tokens(self.tokenizer)
+                # the new tokens change the ids of the cached prompts
+                self._tokenize_cached.cache_clear()
 
             if type == 'text':
-                text = self.tokenizer(data).to(we.device_id)
+                text = self.tokenize(data)
                 return cond_stage_model.encode_text(text)
             elif type == 'image':
                 return cond_stage_model.encode_image(data)
             elif type == 'hybrid':
-                text = self.tokenizer(data).to(we.device_id)
+                text = self.tokenize(data)
                 return cond_stage_model.encode_text(text, data2)
 
+    def encode_condition_batch(self, prompts):
+        # tokenize and encode several prompts with one text encoder forward,
+        # the results are split back per prompt.
+        texts, sizes = [], []
+        for prompt in prompts:
+            prompt = prompt if isinstance(prompt, list) else [prompt]
+            texts.extend(prompt)
+            sizes.append(len(prompt))
+        self.wait_ready(self.cond_stage_model)
+        cond_stage_model = get_model(self.cond_stage_model)
+        with torch.autocast(device_type='cuda', enabled=False):
+            text = self.tokenize(texts)
+            return list(cond_stage_model.encode_text(text).split(sizes))
+
     def process_edit_image(self, images, height, width):
         if not isinstance(images, list):
             images = [images]
-        tensors = []
-        for img in images:
-            w, h = img.size
-            if not h == height or not w == width:
-                scale = max(width / w, height / h)
-                new_size = (int(h * scale), int(w * scale))
-                img = TF.resize(img,
-                                new_size,
-                                interpolation=TF.InterpolationMode.BICUBIC)
-                img = TF.center_crop(img, (height, width))
-            tensor = TF.to_tensor(img).to(we.device_id)
-            tensors.append(tensor)
-        tensors = TF.normalize(torch.stack(tensors),
-                               mean=[0.5, 0.5, 0.5],
-                               std=[0.5, 0.5, 0.5])
-        return tensors
-
-    @torch.no_grad()
+        return self.images_to_tensor(images, height, width)
+
+    def process_exemplar_image(self, images):
+        if not isinstance(images, list):
+            images = [images]
+        return self.images_to_tensor(images,
+                                     224,
+                                     224,
+                                     mean=(0.48145466, 0.4578275, 0.40821073),
+                                     std=(0.26862954, 0.26130258, 0.27577711),
+                                     keep_ratio=False)
+
+    @torch.inference_mode()
     def __call__(self,
                  input,
                  num_samples=1,
@@ -130,11 +139,12 @@ class StyleboothInference(DiffusionInference):
         if not stylebooth_state:
             raise gr.Error('EDIT model must be used with StyleBooth settings')
 
-        value_input = copy.deepcopy(self.input)
-        value_input.update(input)
-        print(value_input)
+        value_input = {**self._input_template, **input}
         height, width = value_input['target_size_as_tuple']
-        value_output = copy.deepcopy(self.output)
+        value_output = {
+            k: ([] if isinstance(v, list) else v)
+            for k, v in self._output_template.items()
+        }
         batch, batch_uc = self.get_batch(value_input, num_samples=1)
 
         # register tuner
@@ -144,6 +154,7 @@ class StyleboothInference(DiffusionInference):
                 tuner_model = [tuner_model]
             self.dynamic_load(self.diffusion_model, 'diffusion_model')
             self.dynamic_load(self.cond_stage_model, 'cond_stage_model')
+            self.wait_ready(self.diffusion_model, self.cond_stage_model)
             self.tuner_infer.register_tuner(tuner_model, self.diffusion_model,
                                             self.cond_stage_model)
             self.dynamic_unload(self.diffusion_model,
@@ -156,6 +167,7 @@ class StyleboothInference(DiffusionInference):
         # register control
         if control_model is not None and control_model != '':
             self.dynamic_load(self.diffusion_model, 'diffusion_model')
+            self.wait_ready(self.diffusion_model)
             self.control_infer.register_controllers(control_model,
                                                     self.diffusion_model)
             self.dynamic_unload(self.diffusion_model,
@@ -166,6 +178,7 @@ class StyleboothInference(DiffusionInference):
         image = input.pop('image', None)
         if image is not None and img_to_img_strength > 0:
             # run image2image
+            image = self.load_image(image)
             b, c, ori_width, ori_height = image.shape
             if not (ori_width == width and ori_height == height):
                 image = F.interpolate(image, (width, height), mode='bicubic')
@@ -179,33 +192,28 @@ class StyleboothInference(DiffusionInference):
         if 'input_latent' in value_output and input_latent is not None:
             value_output['input_latent'] = input_latent
 
-        # cond stage
+        # cond stage, after an image2image encode the weights copy is issued
+        # on the copy stream right after the asynchronous vae encode is
+        # dispatched, so it overlaps the encode still running on the current
+        # stream.
         self.dynamic_load(self.cond_stage_model, 'cond_stage_model')
         context = {}
         if style_exemplar_image is not None:
-            if not isinstance(style_exemplar_image, list):
-                style_exemplar_image = [style_exemplar_image]
-            style_exemplar_image = [
-                TF.resize(x, (224, 224),
-                          interpolation=TF.InterpolationMode.BICUBIC)
-                for x in style_exemplar_image
-            ]
-            style_exemplar_image = [
-                TF.to_tensor(x).to(we.device_id) for x in style_exemplar_image
-            ]
-            style_exemplar_image = TF.normalize(
-                torch.stack(style_exemplar_image),
-                mean=[0.48145466, 0.4578275, 0.40821073],
-                std=[0.26862954, 0.26130258, 0.27577711])
+            style_exemplar_image = self.process_exemplar_image(
+                style_exemplar_image)
             image_feature = self.encode_condition(style_exemplar_image,
                                                   type='image')
             context['crossattn'] = self.encode_condition(batch['prompt'],
                                                          image_feature,
                                                          type='hybrid')
+            null_context = {}
+            null_context['crossattn'] = self.encode_condition(
+                batch_uc['prompt'])
         else:
-            context['crossattn'] = self.encode_condition(batch['prompt'])
-        null_context = {}
-        null_context['crossattn'] = self.encode_condition(batch_uc['prompt'])
+            null_context = {}
+            context['crossattn'], null_context[
+                'crossattn'] = self.encode_condition_batch(
+                    [batch['prompt'], batch_uc['prompt']])
 
         self.dynamic_unload(self.cond_stage_model,
                             'cond_stage_model',
@@ -218,14 +226,14 @@ class StyleboothInference(DiffusionInference):
             style_edit_image = self.process_edit_image(style_edit_image,
                                                        height, width)
             self.dynamic_load(self.first_stage_model, 'first_stage_model')
-            cond_concat = self.encode_first_stage(style_edit_image)
-            cond_concat /= self.first_stage_model['paras']['scale_factor']
+            cond_concat = self.encode_first_stage(style_edit_image,
+                                                  scale=False)
             self.dynamic_unload(self.first_stage_model,
                                 'first_stage_model',
                                 skip_loaded=True)
 
             context['concat'] = cond_concat
-            null_context['concat'] = torch.zeros_like(cond_concat)
+            null_context['concat'] = self.get_zeros_like(cond_concat)
             mid_context = {}
             mid_context.update(null_context)
             mid_context.update({'concat': cond_concat})
@@ -239,22 +247,32 @@ class StyleboothInference(DiffusionInference):
         g.manual_seed(seed)
         if 'seed' in value_output:
             value_output['seed'] = seed
-        for sample_id in range(num_samples):
-            if self.diffusion_model is not None:
-                noise = torch.empty(
-                    1,
-                    4,
-                    height // self.first_stage_model['paras']['size_factor'],
-                    width // self.first_stage_model['paras']['size_factor'],
-                    device=we.device_id).normal_(generator=g)
-
-                self.dynamic_load(self.diffusion_model, 'diffusion_model')
-                # UNet use input n_prompt
-                function_name, dtype = self.get_function_info(
-                    self.diffusion_model)
-                with torch.autocast('cuda',
-                                    enabled=dtype == 'float16',
-                                    dtype=getattr(torch, dtype)):
+        # the latent shape is fixed, refill the same noise buffer per sample.
+        # the buffer is filled contiguous so that a seed gives the same noise
+        # whatever memory format the unet runs in.
+        size_factor = self.first_stage_model['paras']['size_factor']
+        memory_format = torch.channels_last if self.diffusion_model[
+            'paras'].get('channels_last', False) else torch.contiguous_format
+        noise_buf = torch.empty(1,
+                                4,
+                                height // size_factor,
+                                width // size_factor,
+                                device=we.device_id)
+        # the unet autocast context is entered once for all the samples
+        _, dm_dtype = self.get_function_info(self.diffusion_model)
+        dm_torch_dtype = getattr(torch, dm_dtype)
+        dm_enable_ac = dm_dtype == 'float16'
+        with torch.autocast('cuda',
+                            enabled=dm_enable_ac,
+                            dtype=dm_torch_dtype):
+            for sample_id in range(num_samples):
+                if self.diffusion_model is not None:
+                    noise = noise_buf.normal_(generator=g).contiguous(
+                        memory_format=memory_format)
+
+                    self.dynamic_load(self.diffusion_model, 'diffusion_model')
+                    self.wait_ready(self.diffusion_model)
+                    # UNet use input n_prompt
                     latent = self.diffusion.sample(
                         noise=noise,
                         x=input_latent,
@@ -285,29 +303,29 @@ class StyleboothInference(DiffusionInference):
                         cat_uc=value_input.get('cat_uc', cat_uc),
                         **kwargs)
 
-                self.dynamic_unload(self.diffusion_model,
-                                    'diffusion_model',
+                    self.dynamic_unload(self.diffusion_model,
+                                        'diffusion_model',
+                                        skip_loaded=True)
+
+                if 'latent' in value_output:
+                    if value_output['latent'] is None or (
+                            isinstance(value_output['latent'], list)
+                            and len(value_output['latent']) < 1):
+                        value_output['latent'] = []
+                    value_output['latent'].append(latent)
+
+                self.dynamic_load(self.first_stage_model, 'first_stage_model')
+                x_samples = self.decode_first_stage(latent)
+                self.dynamic_unload(self.first_stage_model,
+                                    'first_stage_model',
                                     skip_loaded=True)
-
-            if 'latent' in value_output:
-                if value_output['latent'] is None or (
-                        isinstance(value_output['latent'], list)
-                        and len(value_output['latent']) < 1):
-                    value_output['latent'] = []
-                value_output['latent'].append(latent)
-
-            self.dynamic_load(self.first_stage_model, 'first_stage_model')
-            x_samples = self.decode_first_stage(latent).float()
-            self.dynamic_unload(self.first_stage_model,
-                                'first_stage_model',
-                                skip_loaded=True)
-            images = torch.clamp((x_samples + 1.0) / 2.0, min=0.0, max=1.0)
-            if 'images' in value_output:
-                if value_output['images'] is None or (
-                        isinstance(value_output['images'], list)
-                        and len(value_output['images']) < 1):
-                    value_output['images'] = []
-                value_output['images'].append(images)
+                images = samples_to_images(x_samples)
+                if 'images' in value_output:
+                    if value_output['images'] is None or (
+                            isinstance(value_output['images'], list)
+                            and len(value_output['images']) < 1):
+                        value_output['images'] = []
+                    value_output['images'].append(images)
 
         for k, v in value_output.items():
             if isinstance(v, list):
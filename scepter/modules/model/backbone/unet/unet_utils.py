@@ -4,6 +4,7 @@
 import math
 import warnings
 from abc import abstractmethod
+from functools import lru_cache
 from importlib import find_loader
 
 from packaging import version
@@ -525,6 +526,95 @@ class FeedForward(nn.Module):
         return self.net(x)
 
 
+FP8_E4M3_MAX = 448.
+
+
+@lru_cache()
+def fp8_is_available():
+    """
+    Probe a tiny row-wise scaled fp8 matmul as FP8Linear runs it. The row-wise
+    scales need torch >= 2.5 on a sm90 gpu, older versions only take scalar
+    scales or return an (out, amax) tuple.
+    """
+    if not (hasattr(torch, 'float8_e4m3fn') and hasattr(torch, '_scaled_mm')
+            and torch.cuda.is_available()):
+        return False
+    try:
+        a = torch.ones(16, 16, device='cuda').to(torch.float8_e4m3fn)
+        b = torch.ones(16, 16, device='cuda').to(torch.float8_e4m3fn)
+        out = torch._scaled_mm(a,
+                               b.t(),
+                               scale_a=torch.ones(16, 1, device='cuda'),
+                               scale_b=torch.ones(1, 16, device='cuda'),
+                               bias=torch.zeros(16,
+                                                dtype=torch.bfloat16,
+                                                device='cuda'),
+                               out_dtype=torch.bfloat16)
+    except (RuntimeError, TypeError):
+        return False
+    return isinstance(out, torch.Tensor) and out.shape == (16, 16)
+
+
+class FP8Linear(nn.Module):
+    """
+    Inference-only replacement of nn.Linear, which keeps an e4m3 weight with
+    per-row scales and quantizes the activations dynamically per row.
+    """
+    def __init__(self, linear, scale_ub=1200.):
+        super().__init__()
+        self.in_features = linear.in_features
+        self.out_features = linear.out_features
+        self.scale_ub = scale_ub
+        weight = linear.weight.detach().float()
+        weight_scale = weight.abs().amax(
+            dim=1, keepdim=True).clamp(min=1e-12) / FP8_E4M3_MAX
+        self.register_buffer('weight_fp8',
+                             (weight / weight_scale).to(torch.float8_e4m3fn))
+        self.register_buffer('weight_scale', weight_scale.t().contiguous())
+        if linear.bias is not None:
+            self.register_buffer('bias',
+                                 linear.bias.detach().to(torch.bfloat16))
+        else:
+            self.bias = None
+
+    def forward(self, x):
+        shape = x.shape
+        x = x.reshape(-1, shape[-1])
+        x_scale = x.abs().amax(dim=1, keepdim=True).float().clamp(
+            min=1e-12, max=self.scale_ub) / FP8_E4M3_MAX
+        x_fp8 = (x.float() / x_scale).clamp(
+            -FP8_E4M3_MAX, FP8_E4M3_MAX).to(torch.float8_e4m3fn)
+        out = torch._scaled_mm(x_fp8,
+                               self.weight_fp8.t(),
+                               scale_a=x_scale,
+                               scale_b=self.weight_scale,
+                               bias=self.bias,
+                               out_dtype=torch.bfloat16)
+        return out.to(x.dtype).reshape(*shape[:-1], self.out_features)
+
+
+def convert_feedforward_to_fp8(model, skip_first_last=True):
+    """
+    Replace the linears of the FeedForward blocks with FP8Linear in place.
+    The first and last FeedForward blocks and all attention projections keep
+    their original precision.
+    :param model: the module to convert.
+    :param skip_first_last: keep the first and last FeedForward blocks.
+    :return: the number of converted linears.
+    """
+    ffs = [m for m in model.modules() if isinstance(m, FeedForward)]
+    if skip_first_last:
+        ffs = ffs[1:-1]
+    targets = [(parent, name, child) for ff in ffs
+               for parent in ff.modules()
+               for name, child in parent.named_children()
+               if isinstance(child, nn.Linear) and child.in_features %
+               16 == 0 and child.out_features % 16 == 0]
+    for parent, name, child in targets:
+        setattr(parent, name, FP8Linear(child))
+    return len(targets)
+
+
 class MultiHeadAttention(nn.Module):
     def __init__(self,
                  dim,
@@ -42,6 +42,13 @@ def autocast(f, enabled=True):
     return do_autocast
 
 
+def load_checkpoint(path):
+    if path.endswith('safetensors'):
+        from safetensors.torch import load_file as load_safetensors
+        return load_safetensors(path)
+    return torch.load(path, map_location='cpu')
+
+
 @EMBEDDERS.register_class()
 class FrozenCLIPEmbedder(BaseEmbedder):
     """Uses the CLIP transformer encoder for text (from huggingface)"""
@@ -236,7 +243,8 @@ class FrozenOpenCLIPEmbedder(BaseEmbedder):
         if cfg.PRETRAINED_MODEL is not None:
             with FS.get_from(cfg.PRETRAINED_MODEL,
                              wait_finish=True) as local_path:
-                model.load_state_dict(torch.load(local_path), strict=False)
+                model.load_state_dict(load_checkpoint(local_path),
+                                      strict=False)
         self.model = model
 
         self.use_grad = cfg.get('USE_GRAD', False)
@@ -372,9 +380,19 @@ class FrozenOpenCLIPEmbedder2(BaseEmbedder):
         else:
             with FS.get_from(cfg.PRETRAINED_MODEL,
                              wait_finish=True) as local_path:
-                model, _, _ = open_clip.create_model_and_transforms(
-                    arch, device=torch.device('cpu'), pretrained=local_path)
-                del model.visual
+                if local_path.endswith('safetensors'):
+                    # older open_clip versions torch.load the pretrained path
+                    model, _, _ = open_clip.create_model_and_transforms(
+                        arch, device=torch.device('cpu'), pretrained=None)
+                    del model.visual
+                    model.load_state_dict(load_checkpoint(local_path),
+                                          strict=False)
+                else:
+                    model, _, _ = open_clip.create_model_and_transforms(
+                        arch,
+                        device=torch.device('cpu'),
+                        pretrained=local_path)
+                    del model.visual
         self.model = model
 
         self.max_length = cfg.get('MAX_LENGTH', 77)
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) Alibaba, Inc. and its affiliates.
+
+import unittest
+
+import torch
+import torch.nn as nn
+from scepter.modules.model.backbone.unet.unet_utils import (FP8Linear,
+                                                             fp8_is_available)
+
+
+class FP8LinearTest(unittest.TestCase):
+    def setUp(self):
+        print(('Testing %s.%s' % (type(self).__name__, self._testMethodName)))
+
+    def tearDown(self):
+        super().tearDown()
+
+    @unittest.skipUnless(fp8_is_available(), 'fp8 matmul is not available')
+    def test_fp8_linear_matches_linear(self):
+        torch.manual_seed(0)
+        linear = nn.Linear(256, 512).cuda()
+        fp8_linear = FP8Linear(linear)
+        x = torch.randn(2, 77, 256, device='cuda', dtype=torch.bfloat16)
+        with torch.no_grad():
+            ref = linear.to(torch.bfloat16)(x).float()
+            out = fp8_linear(x).float()
+        self.assertEqual(out.shape, ref.shape)
+        self.assertEqual(fp8_linear(x).dtype, x.dtype)
+        rel_err = (out - ref).norm() / ref.norm()
+        self.assertLess(rel_err.item(), 0.05)
+
+
+if __name__ == '__main__':
+    unittest.main()
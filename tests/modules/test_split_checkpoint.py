@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) Alibaba, Inc. and its affiliates.
+
+import os
+import tempfile
+import unittest
+
+import torch
+from scepter.modules.inference.diffusion_inference import (DiffusionInference,
+                                                           split_state_key)
+from scepter.modules.inference.largen_inference import LargenInference
+from scepter.modules.model.embedder.embedder import load_checkpoint
+from scepter.modules.utils.logger import get_logger
+
+
+class SplitCheckpointTest(unittest.TestCase):
+    def setUp(self):
+        print(('Testing %s.%s' % (type(self).__name__, self._testMethodName)))
+        self.logger = get_logger(name='scepter')
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.sd = {
+            'first_stage_model.decoder.conv_in.weight': torch.randn(4, 4),
+            'conditioner.embedders.0.proj.weight': torch.randn(4, 4),
+            'cond_stage_model.model.positional_embedding': torch.randn(4, 4),
+            'model.diffusion_model.out.0.weight': torch.randn(4),
+            'model.out.1.bias': torch.randn(4),
+            'model_ema.decay': torch.tensor(0.999)
+        }
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+        super().tearDown()
+
+    def split(self, infer, local_path):
+        names = ('first_stage_model', 'cond_stage_model', 'diffusion_model')
+        module_paths = {
+            name: os.path.join(self.tmp_dir.name, f'{name}.safetensors')
+            for name in names
+        }
+        infer.split_checkpoint(local_path, module_paths, list(names))
+        return {name: load_checkpoint(module_paths[name]) for name in names}
+
+    def test_split_state_key(self):
+        self.assertEqual(split_state_key('model.diffusion_model.out.0.weight'),
+                         ('diffusion_model', 'out.0.weight'))
+        self.assertEqual(
+            split_state_key('cond_stage_model.model.positional_embedding'),
+            ('cond_stage_model', 'positional_embedding'))
+        self.assertEqual(split_state_key('model.out.1.bias'), (None, None))
+        self.assertEqual(
+            LargenInference(logger=self.logger).split_state_key(
+                'model.out.1.bias'), ('diffusion_model', 'out.1.bias'))
+
+    def test_split_torch_checkpoint(self):
+        local_path = os.path.join(self.tmp_dir.name, 'model.ckpt')
+        torch.save({'model': self.sd}, local_path)
+        modules = self.split(DiffusionInference(logger=self.logger),
+                             local_path)
+        self.assertEqual(set(modules['first_stage_model']),
+                         {'decoder.conv_in.weight'})
+        self.assertEqual(set(modules['cond_stage_model']),
+                         {'embedders.0.proj.weight', 'positional_embedding'})
+        self.assertEqual(set(modules['diffusion_model']), {'out.0.weight'})
+        self.assertTrue(
+            torch.equal(modules['diffusion_model']['out.0.weight'],
+                        self.sd['model.diffusion_model.out.0.weight']))
+
+    def test_split_safetensors_checkpoint(self):
+        from safetensors.torch import save_file
+        local_path = os.path.join(self.tmp_dir.name, 'model.safetensors')
+        save_file(self.sd, local_path)
+        modules = self.split(LargenInference(logger=self.logger), local_path)
+        self.assertEqual(set(modules['diffusion_model']),
+                         {'out.0.weight', 'out.1.bias'})
+
+
+if __name__ == '__main__':
+    unittest.main()